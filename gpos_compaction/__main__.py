@@ -1,6 +1,7 @@
 import argparse
 import csv
 import sys
+from concurrent.futures import ProcessPoolExecutor
 from io import BytesIO
 from pathlib import Path
 from typing import Any, List, Optional, Tuple
@@ -17,73 +18,86 @@ def main(args: Optional[List[str]] = None):
     parser.add_argument("fonts", type=Path, nargs="+", help="Path to TTFs.")
     parsed_args = parser.parse_args()
 
-    rows = []
-    font_path: Path
-    for font_path in parsed_args.fonts:
-        font = TTFont(font_path)
-        if "GPOS" not in font:
-            print(f"No GPOS in {font_path.name}, skipping.", file=sys.stderr)
-            continue
-        size_orig = len(font.getTableData("GPOS")) / 1024
-        print(f"Measuring {font_path.name}...", file=sys.stderr)
-
-        font_one = TTFont(font_path)
-        compact(font_one, mode="one")
-        font_one_path = font_path.with_name(font_path.stem + "_one" + font_path.suffix)
-        font_one.save(font_one_path)
-        font_one = TTFont(font_one_path)
-        size_one = len(font_one.getTableData("GPOS")) / 1024
-
-        font_max = TTFont(font_path)
-        compact(font_max, mode="max")
-        font_max_path = font_path.with_name(font_path.stem + "_max" + font_path.suffix)
-        font_max.save(font_max_path)
-        font_max = TTFont(font_max_path)
-        size_max = len(font_max.getTableData("GPOS")) / 1024
-
-        font_auto = TTFont(font_path)
-        compact(font_auto, mode="auto")
-        font_auto_path = font_path.with_name(
-            font_path.stem + "_auto" + font_path.suffix
-        )
-        font_auto.save(font_auto_path)
-        font_auto = TTFont(font_auto_path)
-        size_auto = len(font_auto.getTableData("GPOS")) / 1024
-
-        # Bonus: measure WOFF2 file sizes.
-        size_woff_orig = woff_size(font, font_path) / 1024
-        size_woff_one = woff_size(font_one, font_one_path) / 1024
-        size_woff_auto = woff_size(font_auto, font_auto_path) / 1024
-        size_woff_max = woff_size(font_max, font_max_path) / 1024
-
-        rows.append(
-            (
-                font_path.name,
-                size_orig,
-                size_woff_orig,
-                size_one,
-                pct(size_one, size_orig),
-                size_woff_one,
-                pct(size_woff_one, size_woff_orig),
-                size_auto,
-                pct(size_auto, size_orig),
-                size_woff_auto,
-                pct(size_woff_auto, size_woff_orig),
-                size_max,
-                pct(size_max, size_orig),
-                size_woff_max,
-                pct(size_woff_max, size_woff_orig),
-            )
-        )
+    with ProcessPoolExecutor() as executor:
+        results = executor.map(measure_font, parsed_args.fonts)
+        rows = [row for row in results if row is not None]
 
     write_csv(rows)
 
 
-def woff_size(font: TTFont, path: Path) -> int:
+def measure_font(font_path: Path) -> Optional[Tuple[Any, ...]]:
+    # TTFont only parses tables on access, so loading a fresh font from the
+    # same bytes for each mode costs little more than decompiling GPOS,
+    # which is faster than deep-copying an already decompiled GPOS.
+    data_orig = font_path.read_bytes()
+    font = TTFont(BytesIO(data_orig))
+    if "GPOS" not in font:
+        print(f"No GPOS in {font_path.name}, skipping.", file=sys.stderr)
+        return None
+    size_orig = len(font.getTableData("GPOS")) / 1024
+    print(f"Measuring {font_path.name}...", file=sys.stderr)
+
+    font_one = TTFont(BytesIO(data_orig))
+    compact(font_one, mode="one")
+    font_one_path = font_path.with_name(font_path.stem + "_one" + font_path.suffix)
+    data_one = save_font(font_one, font_one_path)
+    size_one = len(TTFont(BytesIO(data_one)).getTableData("GPOS")) / 1024
+
+    font_max = TTFont(BytesIO(data_orig))
+    compact(font_max, mode="max")
+    font_max_path = font_path.with_name(font_path.stem + "_max" + font_path.suffix)
+    data_max = save_font(font_max, font_max_path)
+    size_max = len(TTFont(BytesIO(data_max)).getTableData("GPOS")) / 1024
+
+    font_auto = TTFont(BytesIO(data_orig))
+    compact(font_auto, mode="auto")
+    font_auto_path = font_path.with_name(font_path.stem + "_auto" + font_path.suffix)
+    data_auto = save_font(font_auto, font_auto_path)
+    size_auto = len(TTFont(BytesIO(data_auto)).getTableData("GPOS")) / 1024
+
+    # Bonus: measure WOFF2 file sizes.
+    size_woff_orig = woff_size(data_orig) / 1024
+    size_woff_one = woff_size(data_one) / 1024
+    size_woff_auto = woff_size(data_auto) / 1024
+    size_woff_max = woff_size(data_max) / 1024
+
+    return (
+        font_path.name,
+        size_orig,
+        size_woff_orig,
+        size_one,
+        pct(size_one, size_orig),
+        size_woff_one,
+        pct(size_woff_one, size_woff_orig),
+        size_auto,
+        pct(size_auto, size_orig),
+        size_woff_auto,
+        pct(size_woff_auto, size_woff_orig),
+        size_max,
+        pct(size_max, size_orig),
+        size_woff_max,
+        pct(size_woff_max, size_woff_orig),
+    )
+
+
+def save_font(font: TTFont, path: Path) -> bytes:
+    # Compile once in memory and hand the bytes back for measuring, so that
+    # nothing needs to read the file again.
+    buf = BytesIO()
+    font.save(buf)
+    data = buf.getvalue()
+    path.write_bytes(data)
+    return data
+
+
+def woff_size(data: bytes) -> int:
+    # Load a fresh font from the compiled data, its tables are copied over
+    # as they are instead of being decompiled and compiled again.
+    font = TTFont(BytesIO(data))
     font.flavor = "woff2"
-    woff_path = path.with_suffix(".woff2")
-    font.save(woff_path)
-    return woff_path.stat().st_size
+    buf = BytesIO()
+    font.save(buf)
+    return len(buf.getvalue())
 
 
 def write_csv(rows: List[Tuple[Any]]) -> None:
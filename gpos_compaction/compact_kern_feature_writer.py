@@ -12,13 +12,16 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import logging
 from collections import defaultdict
 from types import SimpleNamespace
 from typing import Any, Callable, DefaultDict, Dict, List, Optional, Sequence, Tuple
 
 import fontTools
+import numpy as np
+import sklearn
 from fontTools.designspaceLib import DesignSpaceDocument
-from fontTools.otlLib.builder import buildPairPosClassesSubtable
+from fontTools.otlLib.builder import ClassDefBuilder, buildCoverage
 from fontTools.ttLib.tables import otTables
 from fontTools.ttLib.tables.otBase import ValueRecord
 from fontTools.ttLib.ttFont import TTFont
@@ -26,10 +29,26 @@ from sklearn import cluster
 from ufo2ft.featureWriters import ast
 from ufo2ft.featureWriters.kernFeatureWriter import KernFeatureWriter
 
+log = logging.getLogger(__name__)
+
+# Class pair subtables with fewer non-zero pairs than this, or with at least
+# this proportion of non-zero cells, are kept as they are.
+MIN_PAIRS_TO_COMPACT = 32
+MAX_DENSITY_TO_COMPACT = 0.9
+
 
 def compact(ttf: TTFont, mode: str, clustering_kwargs: Dict[str, Any] = {}) -> TTFont:
     # print("Compacting GPOS...")
-    config = {"mode": mode, "clustering_kwargs": clustering_kwargs}
+    # Checked up front as subtables that are kept as they are never look at
+    # the mode.
+    if mode not in ("one", "max", "auto"):
+        raise ValueError(f"Bad mode {mode}")
+    config = {
+        "mode": mode,
+        "clustering_kwargs": clustering_kwargs,
+        # Glyph classes seen so far, see intern_class
+        "interned_classes": {},
+    }
     # Plan:
     #  1. Find lookups of Lookup Type 2: Pair Adjustment Positioning Subtable
     #     https://docs.microsoft.com/en-us/typography/opentype/spec/gpos#lookup-type-2-pair-adjustment-positioning-subtable
@@ -93,78 +112,177 @@ def compact_class_pairs(
     subtable: fontTools.ttLib.tables.otTables.PairPos,
 ) -> List[fontTools.ttLib.tables.otTables.PairPos]:
     subtables = []
+    reverse_glyph_map = ttf.getReverseGlyphMap()
     classes1: DefaultDict[int, List[str]] = defaultdict(list)
+    class1_of = subtable.ClassDef1.classDefs.get
     for g in subtable.Coverage.glyphs:
-        classes1[subtable.ClassDef1.classDefs.get(g, 0)].append(g)
+        classes1[class1_of(g, 0)].append(g)
     classes2: DefaultDict[int, List[str]] = defaultdict(list)
     for g, i in subtable.ClassDef2.classDefs.items():
         classes2[i].append(g)
+    class1_tuples = {i: intern_class(config, glyphs) for i, glyphs in classes1.items()}
+    class2_tuples = {i: intern_class(config, glyphs) for i, glyphs in classes2.items()}
+    # A side whose ValueFormat is 0 has no fields at all, skip checking it.
+    check_value1 = subtable.ValueFormat1 != 0
+    check_value2 = subtable.ValueFormat2 != 0
     all_pairs = {}
     for i, class1 in enumerate(subtable.Class1Record):
         for j, class2 in enumerate(class1.Class2Record):
-            if is_really_zero(class2.Value1) and is_really_zero(class2.Value2):
+            if (not check_value1 or is_really_zero(class2.Value1)) and (
+                not check_value2 or is_really_zero(class2.Value2)
+            ):
                 continue
-            all_pairs[(tuple(classes1[i]), tuple(classes2[j]))] = (
+            all_pairs[(class1_tuples.get(i, ()), class2_tuples.get(j, ()))] = (
                 class2.Value1,
                 class2.Value2,
             )
 
-    if config["mode"] == "one":
-        subtables.append(
-            buildPairPosClassesSubtable(all_pairs, ttf.getReverseGlyphMap())
+    # Leave alone subtables that are too small or too full for regrouping to
+    # pay off. Only count the cells between classes that have glyphs: Class2
+    # class 0 is usually empty.
+    cells = len(class1_tuples) * len(class2_tuples)
+    if len(all_pairs) < MIN_PAIRS_TO_COMPACT or (
+        len(all_pairs) >= MAX_DENSITY_TO_COMPACT * cells
+    ):
+        log.debug(
+            "Keeping subtable with %d non-zero pairs out of %d as it is",
+            len(all_pairs),
+            cells,
         )
+        return [subtable]
+
+    if config["mode"] == "one":
+        subtables.append(build_class_pairs_subtable(all_pairs, reverse_glyph_map))
     elif config["mode"] == "max":
         groups: Dict[Any, Any] = defaultdict(dict)
         for pair, values in all_pairs.items():
             groups[pair[0]][pair] = values
         for pairs in groups.values():
-            subtables.append(
-                buildPairPosClassesSubtable(pairs, ttf.getReverseGlyphMap())
-            )
+            subtables.append(build_class_pairs_subtable(pairs, reverse_glyph_map))
     elif config["mode"] == "auto":
         if len(classes1) < 2:
             # Skip optimizations because clustering requires at least 2 things to cluster.
-            subtables.append(
-                buildPairPosClassesSubtable(all_pairs, ttf.getReverseGlyphMap())
-            )
+            subtables.append(build_class_pairs_subtable(all_pairs, reverse_glyph_map))
         else:
             grouped_pairs = cluster_pairs_by_class2_coverage(
                 all_pairs, config["clustering_kwargs"]
             )
             for pairs in grouped_pairs:
-                subtables.append(
-                    buildPairPosClassesSubtable(pairs, ttf.getReverseGlyphMap())
-                )
+                subtables.append(build_class_pairs_subtable(pairs, reverse_glyph_map))
     else:
-        raise ValueError(f"Bad config {config}")
+        raise ValueError(f"Bad mode {config['mode']}")
     return subtables
 
 
+def build_class_pairs_subtable(
+    pairs: "Pairs", reverse_glyph_map: Dict[str, int]
+) -> fontTools.ttLib.tables.otTables.PairPos:
+    """Build a class pair subtable, like fontTools' buildPairPosClassesSubtable.
+
+    The ClassDef builders are fed each distinct class once instead of once per
+    pair, and the sorted class lists are computed once and reused for the
+    ClassDefs and the class records. This adds up in the "max" and "auto"
+    modes, which build many subtables per lookup.
+    """
+    class_def1 = ClassDefBuilder(useClass0=True)
+    class_def2 = ClassDefBuilder(useClass0=False)
+    for class1 in dict.fromkeys(pair[0] for pair in pairs):
+        class_def1.add(class1)
+    for class2 in dict.fromkeys(pair[1] for pair in pairs):
+        class_def2.add(class2)
+    value_format1 = value_format2 = 0
+    for value1, value2 in pairs.values():
+        if value1 is not None:
+            value_format1 |= value1.getFormat()
+        if value2 is not None:
+            value_format2 |= value2.getFormat()
+    classes1 = class_def1.classes()
+    classes2 = class_def2.classes()
+
+    subtable = otTables.PairPos()
+    subtable.Format = 2
+    subtable.ValueFormat1 = value_format1
+    subtable.ValueFormat2 = value_format2
+    subtable.Coverage = buildCoverage(
+        [glyph for glyphs in classes1 for glyph in glyphs], reverse_glyph_map
+    )
+    subtable.ClassDef1 = build_class_def(classes1)
+    subtable.ClassDef2 = build_class_def(classes2)
+    subtable.Class1Record = []
+    for class1 in classes1:
+        class1_record = otTables.Class1Record()
+        class1_record.Class2Record = []
+        subtable.Class1Record.append(class1_record)
+        for class2 in classes2:
+            class2_record = otTables.Class2Record()
+            value1, value2 = pairs.get((class1, class2), (None, None))
+            class2_record.Value1 = (
+                ValueRecord(src=value1, valueFormat=value_format1)
+                if value_format1
+                else None
+            )
+            class2_record.Value2 = (
+                ValueRecord(src=value2, valueFormat=value_format2)
+                if value_format2
+                else None
+            )
+            class1_record.Class2Record.append(class2_record)
+    subtable.Class1Count = len(subtable.Class1Record)
+    subtable.Class2Count = len(classes2)
+    return subtable
+
+
+def build_class_def(
+    classes: List[Sequence[str]],
+) -> fontTools.ttLib.tables.otTables.ClassDef:
+    # Class 0 is never encoded, see ClassDefBuilder.classes().
+    class_def = otTables.ClassDef()
+    class_def.classDefs = {}
+    for class_id, glyphs in enumerate(classes[1:], start=1):
+        for glyph in glyphs:
+            class_def.classDefs[glyph] = class_id
+    return class_def
+
+
+def intern_class(config: Dict[str, Any], glyphs: List[str]) -> Tuple[str, ...]:
+    # The same class found in several subtables or lookups of one compact()
+    # call becomes one tuple object. Dict lookups on an identical key object
+    # skip comparing the glyph names one by one.
+    glyph_tuple = tuple(glyphs)
+    return config["interned_classes"].setdefault(glyph_tuple, glyph_tuple)
+
+
 def is_really_zero(value: Optional[ValueRecord]) -> bool:
-    if value is None:
-        return True
-    return all(
-        getattr(value, attr, 0) == 0
-        for attr in (
-            "XPlacement",
-            "YPlacement",
-            "XAdvance",
-            "YAdvance",
-        )
-    ) and all(
-        getattr(value, attr, None) is None
-        for attr in (
-            # TODO: check that it's zero also in the variation deltas
-            "XPlaDevice"
-            "YPlaDevice"
-            "XAdvDevice"
-            "YAdvDevice"
-        )
+    # Attributes are checked most-likely-nonzero first so that the common
+    # kerning case bails out on XAdvance.
+    # TODO: check that it's zero also in the variation deltas
+    return value is None or (
+        getattr(value, "XAdvance", 0) == 0
+        and getattr(value, "XPlacement", 0) == 0
+        and getattr(value, "YPlacement", 0) == 0
+        and getattr(value, "YAdvance", 0) == 0
+        and getattr(value, "XPlaDevice", None) is None
+        and getattr(value, "YPlaDevice", None) is None
+        and getattr(value, "XAdvDevice", None) is None
+        and getattr(value, "YAdvDevice", None) is None
     )
 
 
 Pairs = Dict[Tuple[Tuple[str, ...], Tuple[str, ...]], Any]
 
+# Number of distinct Class1 lines above which Ward clustering is preceded by a
+# Birch pre-clustering step when clustering_kwargs has a "birch_threshold",
+# see cluster_lines.
+BIRCH_MIN_LINES = 500
+
+# AgglomerativeClustering's affinity parameter was renamed to metric in
+# scikit-learn 1.2.
+SKLEARN_METRIC_KEYWORD = (
+    "metric"
+    if tuple(int(part) for part in sklearn.__version__.split(".")[:2]) >= (1, 2)
+    else "affinity"
+)
+
 
 def cluster_pairs_by_class2_coverage(
     pairs: Pairs, clustering_kwargs: Dict[str, Any]
@@ -176,20 +294,31 @@ def cluster_pairs_by_class2_coverage(
     # That way, we hope to have fewer subtables than in the "max" strategy,
     # but that each subtable will have high occupancy/low sparsity thanks to
     # the clustering.
-    all_class1 = list(set(pair[0] for pair in pairs))
-    all_class2 = list(set(pair[1] for pair in pairs))
-    vectors = [
-        [1 if (class1, class2) in pairs else 0 for class2 in all_class2]
-        for class1 in all_class1
-    ]
-    # Make matrix lines
+    # Make matrix lines, collecting the Class2 columns in the same pass
     lines: Dict[Sequence[str], Pairs] = defaultdict(dict)
+    seen_class2: Dict[Sequence[str], None] = {}
     for pair, values in pairs.items():
         lines[pair[0]][pair] = values
+        seen_class2[pair[1]] = None
+    # Sort so that the matrix, and hence the clustering, doesn't depend on
+    # the order in which the pairs were found.
+    all_class1 = sorted(lines)
+    all_class2 = sorted(seen_class2)
+    # Binary matrix of which Class2 each Class1 line has a value for.
+    row_of = {class1: i for i, class1 in enumerate(all_class1)}
+    col_of = {class2: j for j, class2 in enumerate(all_class2)}
+    vectors = np.zeros((len(all_class1), len(all_class2)), dtype=np.uint8)
+    for class1, class2 in pairs:
+        vectors[row_of[class1], col_of[class2]] = 1
     # https://scikit-learn.org/stable/modules/generated/sklearn.cluster.AgglomerativeClustering.html
     # Default values determined by running:
     # python -m scripts.measure_kerning_optimizations.find_best_clustering
     kwargs = {**clustering_kwargs}  # Shallow copy to edit defaults
+    if kwargs.get("metric") == "hamming":
+        # Ward only works on Euclidean distances
+        kwargs.setdefault("linkage", "average")
+        if kwargs["linkage"] == "ward":
+            raise ValueError("The hamming metric cannot be used with ward linkage")
     if "lines_per_cluster" in kwargs:
         lines_per_cluster = kwargs.pop("lines_per_cluster")
         kwargs["n_clusters"] = min(
@@ -201,13 +330,98 @@ def cluster_pairs_by_class2_coverage(
         kwargs.setdefault("n_clusters", None)
         kwargs.setdefault("linkage", "ward")
         kwargs.setdefault("distance_threshold", 5.5)
-    labels = cluster.AgglomerativeClustering(**kwargs).fit_predict(vectors)
-    # Group matrix lines according to clustering
-    grouped_lines: Dict[int, Pairs] = defaultdict(dict)
-    ungrouped_lines = []
-    for class1, label in zip(all_class1, labels):
-        if label == -1:
-            ungrouped_lines.append(lines[class1])
+    labels = cluster_lines(vectors, kwargs)
+    # Group matrix lines according to clustering: sort line indices by label
+    # and cut where the label changes.
+    order = np.argsort(labels, kind="stable")
+    boundaries = np.flatnonzero(np.diff(labels[order])) + 1
+    grouped_lines: List[Pairs] = []
+    ungrouped_lines: List[Pairs] = []
+    for indices in np.split(order, boundaries):
+        if labels[indices[0]] == -1:
+            ungrouped_lines.extend(lines[all_class1[i]] for i in indices)
+        else:
+            merged: Pairs = {}
+            for i in indices:
+                merged.update(lines[all_class1[i]])
+            grouped_lines.append(merged)
+    return [*grouped_lines, *ungrouped_lines]
+
+
+def cluster_lines(vectors: np.ndarray, kwargs: Dict[str, Any]) -> np.ndarray:
+    """Return a cluster label for each line of the binary coverage matrix."""
+    birch_threshold = kwargs.pop("birch_threshold", None)
+    if kwargs["distance_threshold"] is not None:
+        # Lines with the same Class2 coverage are at distance 0, so they end
+        # up in the same cluster under a distance threshold: only cluster the
+        # distinct ones and map the labels back afterwards. The clusters can
+        # still differ slightly from clustering all lines, as Ward no longer
+        # weighs each coverage by its number of lines.
+        unique_vectors, unique_index = np.unique(vectors, axis=0, return_inverse=True)
+        unique_index = unique_index.reshape(-1)
+    else:
+        # With n_clusters, dropping the duplicates would change which
+        # clusters get merged, so cluster every line.
+        unique_vectors, unique_index = vectors, np.arange(len(vectors))
+    if len(unique_vectors) < 2:
+        unique_labels = np.zeros(len(unique_vectors), dtype=np.intp)
+    elif kwargs.get("metric") == "hamming":
+        # Opt-in: compare lines by the number of Class2 in which they differ,
+        # computed on bit-packed lines. This is the squared Euclidean distance
+        # of the lines, so distance_threshold needs tuning for this metric.
+        del kwargs["metric"]
+        kwargs[SKLEARN_METRIC_KEYWORD] = "precomputed"
+        unique_labels = cluster.AgglomerativeClustering(**kwargs).fit_predict(
+            hamming_distances(unique_vectors)
+        )
+    elif birch_threshold is not None and len(unique_vectors) > BIRCH_MIN_LINES:
+        # Opt-in: Ward needs the full pairwise distance matrix, O(n^2) memory.
+        # For very large matrices, first summarize the lines into a Birch
+        # CF-tree, then run the same clustering on the subcluster centroids.
+        # This is slower than plain Ward at the sizes found in fonts so far,
+        # and gives different clusters: distance_threshold then applies to
+        # the Ward distances between centroids, not between lines.
+        birch = cluster.Birch(threshold=birch_threshold, n_clusters=None).fit(
+            unique_vectors
+        )
+        centers = birch.subcluster_centers_
+        if kwargs["n_clusters"] is not None:
+            kwargs["n_clusters"] = min(kwargs["n_clusters"], len(centers))
+        if len(centers) < 2:
+            unique_labels = np.zeros(len(unique_vectors), dtype=np.intp)
         else:
-            grouped_lines[label].update(lines[class1])
-    return [*grouped_lines.values(), *ungrouped_lines]
+            center_labels = cluster.AgglomerativeClustering(**kwargs).fit_predict(
+                centers
+            )
+            unique_labels = center_labels[birch.labels_]
+    else:
+        unique_labels = cluster.AgglomerativeClustering(**kwargs).fit_predict(
+            unique_vectors
+        )
+    return unique_labels[unique_index]
+
+
+# Number of set bits in each possible byte value.
+POPCOUNT = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+
+def hamming_distances(vectors: np.ndarray) -> np.ndarray:
+    """Return the pairwise Hamming distances between the rows of a binary
+    matrix, as the number of columns in which two rows differ."""
+    bits = np.packbits(vectors, axis=1)
+    # Pad to whole 64-bit words so that XOR and popcount run a word at a time.
+    words = np.pad(bits, ((0, 0), (0, -bits.shape[1] % 8))).view(np.uint64)
+    distances = np.zeros((len(words), len(words)), dtype=np.float64)
+    # The matrix is symmetric, only compute the upper triangle.
+    for i in range(len(words) - 1):
+        row_distances = count_set_bits(np.bitwise_xor(words[i + 1 :], words[i]))
+        distances[i, i + 1 :] = row_distances
+        distances[i + 1 :, i] = row_distances
+    return distances
+
+
+def count_set_bits(words: np.ndarray) -> np.ndarray:
+    """Return the number of set bits in each row of a uint64 matrix."""
+    if hasattr(np, "bitwise_count"):  # NumPy >= 2.0
+        return np.bitwise_count(words).sum(axis=1)
+    return POPCOUNT[words.view(np.uint8)].sum(axis=1)
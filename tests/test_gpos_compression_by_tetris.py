@@ -1,5 +1,220 @@
-from gpos_compaction import __version__
+from io import BytesIO
+
+import numpy as np
+import pytest
+from fontTools.feaLib.builder import addOpenTypeFeaturesFromString
+from fontTools.fontBuilder import FontBuilder
+from fontTools.otlLib.builder import buildPairPosClassesSubtable
+from fontTools.pens.ttGlyphPen import TTGlyphPen
+from fontTools.ttLib import TTFont
+from fontTools.ttLib.tables.otBase import ValueRecord
+from fontTools.ttLib.tables.otTables import Device
+from scipy.spatial.distance import pdist, squareform
+from sklearn.cluster import AgglomerativeClustering
+
+from gpos_compaction import __version__, compact_kern_feature_writer
+from gpos_compaction.compact_kern_feature_writer import (
+    BIRCH_MIN_LINES,
+    MAX_DENSITY_TO_COMPACT,
+    MIN_PAIRS_TO_COMPACT,
+    cluster_lines,
+    cluster_pairs_by_class2_coverage,
+    compact,
+    hamming_distances,
+    is_really_zero,
+)
+
+
+def make_font(left_classes, right_classes, kerned):
+    """Return a font with one class kerning subtable between left_classes
+    and right_classes classes of two glyphs each, with a kerning value for
+    each class pair (i, j) for which kerned(i, j) is true."""
+    left = [[f"l{i}a", f"l{i}b"] for i in range(left_classes)]
+    right = [[f"r{j}a", f"r{j}b"] for j in range(right_classes)]
+    glyph_order = [".notdef"] + [g for glyphs in left + right for g in glyphs]
+    fb = FontBuilder(1000, isTTF=True)
+    fb.setupGlyphOrder(glyph_order)
+    fb.setupGlyf({g: TTGlyphPen(None).glyph() for g in glyph_order})
+    fb.setupHorizontalMetrics({g: (500, 0) for g in glyph_order})
+    fb.setupHorizontalHeader()
+    fb.setupPost()
+    fea = [f"@L{i} = [{' '.join(glyphs)}];" for i, glyphs in enumerate(left)]
+    fea += [f"@R{j} = [{' '.join(glyphs)}];" for j, glyphs in enumerate(right)]
+    fea.append("feature kern {")
+    for i in range(left_classes):
+        for j in range(right_classes):
+            if kerned(i, j):
+                fea.append(f"pos @L{i} @R{j} {-10 - i - j};")
+    fea.append("} kern;")
+    addOpenTypeFeaturesFromString(fb.font, "\n".join(fea))
+    return fb.font
+
+
+def compiled_gpos(font):
+    buf = BytesIO()
+    font.save(buf)
+    return TTFont(buf).getTableData("GPOS")
 
 
 def test_version():
     assert __version__ == '0.1.0'
+
+
+def test_is_really_zero():
+    assert is_really_zero(None)
+    assert is_really_zero(ValueRecord(0x0004))
+    value = ValueRecord(0x0004)
+    value.XAdvance = -20
+    assert not is_really_zero(value)
+    value = ValueRecord(0x0084)
+    value.XAdvDevice = Device()
+    assert not is_really_zero(value)
+
+
+@pytest.mark.parametrize("width", [63, 64, 65])
+@pytest.mark.parametrize("bitwise_count", [True, False])
+def test_hamming_distances(monkeypatch, width, bitwise_count):
+    if not bitwise_count:
+        monkeypatch.delattr(np, "bitwise_count", raising=False)
+    vectors = (np.random.default_rng(width).random((40, width)) < 0.3).astype(np.uint8)
+    expected = squareform(pdist(vectors, "hamming")) * width
+    assert np.array_equal(hamming_distances(vectors), np.rint(expected))
+
+
+@pytest.mark.parametrize("mode", ["one", "max", "auto"])
+def test_build_class_pairs_subtable_matches_fonttools(monkeypatch, mode):
+    def kerned(i, j):
+        # Five bands of Class2 coverage plus some scattered pairs, so that
+        # "auto" splits the subtable into several clusters.
+        return j // 8 == i % 5 or (i * 7 + j) % 11 == 0
+
+    font = make_font(30, 40, kerned)
+    compact(font, mode=mode)
+    expected_font = make_font(30, 40, kerned)
+    monkeypatch.setattr(
+        compact_kern_feature_writer,
+        "build_class_pairs_subtable",
+        buildPairPosClassesSubtable,
+    )
+    compact(expected_font, mode=mode)
+    assert compiled_gpos(font) == compiled_gpos(expected_font)
+
+
+@pytest.mark.parametrize(
+    "left_classes, right_classes, kerned",
+    [
+        # Fewer non-zero pairs than MIN_PAIRS_TO_COMPACT
+        (4, 4, lambda i, j: True),
+        # More non-zero cells than MAX_DENSITY_TO_COMPACT
+        (10, 10, lambda i, j: True),
+        # Fully dense, but less than MAX_DENSITY_TO_COMPACT when counting the
+        # empty Class2 class 0
+        (8, 8, lambda i, j: True),
+    ],
+)
+@pytest.mark.parametrize("mode", ["one", "max", "auto"])
+def test_compact_keeps_tiny_and_dense_subtables(
+    mode, left_classes, right_classes, kerned
+):
+    font = make_font(left_classes, right_classes, kerned)
+    lookup = font["GPOS"].table.LookupList.Lookup[0]
+    (subtable,) = lookup.SubTable
+    non_zero = sum(
+        kerned(i, j) for i in range(left_classes) for j in range(right_classes)
+    )
+    cells = left_classes * right_classes
+    assert non_zero < MIN_PAIRS_TO_COMPACT or non_zero >= MAX_DENSITY_TO_COMPACT * cells
+    compact(font, mode=mode)
+    assert len(lookup.SubTable) == 1
+    assert lookup.SubTable[0] is subtable
+
+
+def test_compact_bad_mode():
+    font = make_font(4, 4, lambda i, j: True)
+    with pytest.raises(ValueError):
+        compact(font, mode="bogus")
+
+
+def make_pairs(lines, columns, seed):
+    """Return pairs between lines and columns classes of one glyph each, with
+    random Class2 coverage for each line."""
+    coverage = np.random.default_rng(seed).random((lines, columns)) < 0.3
+    return {
+        ((f"l{i}",), (f"r{j}",)): (i, j)
+        for i in range(lines)
+        for j in range(columns)
+        if coverage[i, j]
+    }
+
+
+def assert_clusters_cover_pairs(clusters, pairs):
+    assert sum(len(cluster) for cluster in clusters) == len(pairs)
+    assert {pair for cluster in clusters for pair in cluster} == set(pairs)
+    # Each line goes to exactly one cluster
+    lines = [class1 for cluster in clusters for class1 in {p[0] for p in cluster}]
+    assert len(lines) == len(set(lines))
+
+
+@pytest.mark.parametrize("birch_threshold", [None, 1.0])
+def test_cluster_pairs_many_lines(monkeypatch, birch_threshold):
+    pairs = make_pairs(BIRCH_MIN_LINES + 100, 64, seed=0)
+    clustering_kwargs = {}
+    if birch_threshold is None:
+        # Birch is opt-in
+        monkeypatch.delattr(compact_kern_feature_writer.cluster, "Birch")
+    else:
+        clustering_kwargs["birch_threshold"] = birch_threshold
+    clusters = cluster_pairs_by_class2_coverage(pairs, clustering_kwargs)
+    assert_clusters_cover_pairs(clusters, pairs)
+    assert 1 < len(clusters) < BIRCH_MIN_LINES + 100
+
+
+@pytest.mark.parametrize(
+    "clustering_kwargs",
+    [
+        {"metric": "hamming"},
+        {"metric": "hamming", "lines_per_cluster": 4},
+        {"metric": "hamming", "linkage": "complete"},
+    ],
+)
+def test_cluster_pairs_hamming(clustering_kwargs):
+    pairs = make_pairs(40, 30, seed=1)
+    clusters = cluster_pairs_by_class2_coverage(pairs, clustering_kwargs)
+    assert_clusters_cover_pairs(clusters, pairs)
+
+
+def test_cluster_pairs_hamming_ward():
+    pairs = make_pairs(40, 30, seed=1)
+    clustering_kwargs = {"metric": "hamming", "linkage": "ward"}
+    with pytest.raises(ValueError):
+        cluster_pairs_by_class2_coverage(pairs, clustering_kwargs)
+
+
+def test_compact_auto_hamming():
+    def kerned(i, j):
+        return j // 8 == i % 5 or (i * 7 + j) % 11 == 0
+
+    font = make_font(30, 40, kerned)
+    compact(font, "auto", {"metric": "hamming"})
+    assert len(font["GPOS"].table.LookupList.Lookup[0].SubTable) > 1
+
+
+def test_cluster_lines_maps_labels_to_duplicate_lines():
+    rng = np.random.default_rng(2)
+    distinct = np.unique((rng.random((30, 20)) < 0.3).astype(np.uint8), axis=0)
+    index = rng.integers(len(distinct), size=100)
+    kwargs = {"n_clusters": None, "linkage": "ward", "distance_threshold": 5.5}
+    labels = cluster_lines(distinct[index], {**kwargs})
+    # Only the distinct lines are clustered, duplicates get the same label
+    expected = AgglomerativeClustering(**kwargs).fit_predict(distinct)
+    assert np.array_equal(labels, expected[index])
+
+
+def test_cluster_lines_n_clusters_keeps_duplicate_lines():
+    rng = np.random.default_rng(3)
+    distinct = (rng.random((30, 20)) < 0.3).astype(np.uint8)
+    vectors = distinct[rng.integers(len(distinct), size=100)]
+    kwargs = {"n_clusters": 10, "linkage": "ward", "distance_threshold": None}
+    labels = cluster_lines(vectors, {**kwargs})
+    expected = AgglomerativeClustering(**kwargs).fit_predict(vectors)
+    assert np.array_equal(labels, expected)